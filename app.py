@@ -1,43 +1,391 @@
 from flask import Flask, request, jsonify
 from ultralytics import YOLO
+import atexit
 import os
+import sys
 import datetime
-import traceback
+import itertools
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import io
 import numpy as np
 import cv2
+import torch
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    _turbo = TurboJPEG()   # needs the libturbojpeg shared library
+except Exception:
+    _turbo = None
 
 app = Flask(__name__)
+# Reject oversized bodies (413) before they are buffered; ESP32-CAM frames are far smaller
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("MAX_UPLOAD_BYTES", str(4 * 1024 * 1024)))
+
+# ------------- Logging -------------
+# Records are queued by request threads and written to stderr by a listener
+# thread, so terminal/journald I/O never blocks a request. Startup and export
+# progress is INFO; the per-request lines are DEBUG and suppressed by default.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
 
-# Folder to save images
-UPLOAD_FOLDER = "uploads"
+logger = logging.getLogger("skin")
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+# Drain queued records on exit, e.g. the critical one when model loading fails
+atexit.register(_log_listener.stop)
+
+# Folder to save images. To keep archival writes off an SD card, point
+# UPLOAD_FOLDER at a size-capped tmpfs mount, e.g.
+#   mount -t tmpfs -o size=256m tmpfs /srv/skin/uploads
+# Nothing is rotated, so frames there live in RAM until removed.
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", "uploads")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# ------------- Load YOLO model once at startup -------------
+# Upload filenames: startup timestamp + per-process counter, unique even for bursts
+_RUN_ID = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+_seq = itertools.count()
+
+# Saving is for archival only, so it runs in the background off the request path.
+# Pending saves hold their image bytes in memory, so the backlog is capped and
+# saves beyond it are dropped when storage can't keep up.
+SAVE_BACKLOG = int(os.environ.get("SAVE_BACKLOG", "32"))
+_save_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="save")
+_save_slots = threading.BoundedSemaphore(SAVE_BACKLOG)
+
+
+def save_image_async(filepath, img_bytes):
+    """Queue an image for saving; returns False if the backlog is full and it was dropped."""
+    if not _save_slots.acquire(blocking=False):
+        logger.warning("Save backlog full (%d pending), dropping %s", SAVE_BACKLOG, filepath)
+        return False
+    save_image_async(filepath, img_bytes)
+    return True
+
+
+def _save_image(filepath, img_bytes):
+    try:
+        # Unbuffered os-level write: one write() syscall, no Python file object
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(img_bytes)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        logger.debug("Saved: %s, size = %d bytes", filepath, len(img_bytes))
+    except Exception as e:
+        logger.error("Failed to save image: %s", e)
+    finally:
+        _save_slots.release()
+
+
+# ------------- Load YOLO model once per process -------------
 # Put your trained weights file (from Colab) in same folder as this script
 # e.g. "skin.pt" or "best.pt"
 MODEL_PATH = os.environ.get("MODEL_PATH", "skin_model.pt")    # change via env if needed
 MODEL_DEVICE = os.environ.get("MODEL_DEVICE", "cpu")  # 'cpu' or 'cuda'
+USE_CUDA = MODEL_DEVICE.startswith("cuda") and torch.cuda.is_available()
+# 'pt', 'onnx', 'openvino' or 'engine' (TensorRT FP16, CUDA only)
+MODEL_FORMATS = ("pt", "onnx", "openvino", "engine")
+MODEL_FORMAT = os.environ.get("MODEL_FORMAT", "engine" if USE_CUDA else "openvino")
+if MODEL_FORMAT not in MODEL_FORMATS:
+    raise ValueError(f"MODEL_FORMAT must be one of {', '.join(MODEL_FORMATS)}, got {MODEL_FORMAT!r}")
+MODEL_IMGSZ = int(os.environ.get("MODEL_IMGSZ", "640"))
+MODEL_CALIB_DATA = os.environ.get("MODEL_CALIB_DATA")  # skin dataset yaml for INT8 calibration
+# INT8 quantization (openvino only) needs representative calibration images, so it
+# is only enabled when MODEL_CALIB_DATA is set; otherwise OpenVINO runs FP32
+MODEL_INT8 = bool(MODEL_CALIB_DATA) and os.environ.get("MODEL_INT8", "1") == "1"
+CONF_THRES = float(os.environ.get("CONF_THRES", "0.5"))  # detections below this are ignored
+IOU_THRES = float(os.environ.get("IOU_THRES", "0.7"))
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", "8"))  # max images fused into one inference call
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", "0.005"))  # seconds to wait for a batch to fill
 
-print(f"[INFO] Loading model from {MODEL_PATH} on device {MODEL_DEVICE} ...")
-try:
-    model = YOLO(MODEL_PATH, device=MODEL_DEVICE)
-    print("[INFO] Model loaded ✅")
-except Exception as e:
-    tb = traceback.format_exc()
-    print("[ERROR] Failed to load model:")
-    print(tb)
-    # Try fallback to a small official model to keep service alive
+
+def exported_model_path(path):
+    """Return where the MODEL_FORMAT export of the .pt weights lives, or None if not exporting."""
+    if MODEL_FORMAT == "pt" or not path.endswith(".pt"):
+        return None
+    if MODEL_FORMAT == "engine" and not USE_CUDA:
+        logger.error("TensorRT export needs CUDA, using PyTorch weights")
+        return None
+
+    stem = os.path.splitext(path)[0]
+    if MODEL_FORMAT == "engine":
+        return f"{stem}.engine"
+    if MODEL_FORMAT == "openvino":
+        return f"{stem}_int8_openvino_model" if MODEL_INT8 else f"{stem}_openvino_model"
+    if MODEL_FORMAT == "onnx":
+        return f"{stem}.onnx"
+
+
+def export_model(path=MODEL_PATH):
+    """Export the .pt weights for faster inference (`python app.py export`).
+
+    Runs at build time, not in the server: a TensorRT build or INT8 calibration
+    takes minutes, longer than gunicorn lets a worker boot. The export is kept
+    next to the weights and reused by every later start, so it has to run where
+    its output ends up in the deployed files:
+
+    - OpenVINO/ONNX: during the build (bin/post_compile on Heroku, a RUN step in
+      a Docker image), so the artifact ships with the app.
+    - TensorRT: an engine only runs on the GPU it was built on, so run
+      `MODEL_DEVICE=cuda python app.py export` on the serving host before
+      starting gunicorn there.
+    """
+    target = exported_model_path(path)
+    if target is None or os.path.exists(target):
+        return target
+
+    int8 = MODEL_INT8 and MODEL_FORMAT == "openvino"
+    logger.info("Exporting %s to %s (int8=%s) ...", path, MODEL_FORMAT, int8)
+    # Dynamic batch axis so batched requests can share one call
+    kwargs = {"format": MODEL_FORMAT, "imgsz": MODEL_IMGSZ, "int8": int8, "dynamic": True}
+    if int8:
+        kwargs["data"] = MODEL_CALIB_DATA
+    if MODEL_FORMAT == "engine":
+        # FP16 engine: fused kernels on tensor cores, half the weight bandwidth.
+        # TensorRT needs the max batch for its optimization profile.
+        kwargs.update(half=True, workspace=4, device=MODEL_DEVICE, batch=BATCH_SIZE)
+    return YOLO(path).export(**kwargs)
+
+
+def resolve_model_path(path):
+    """Return the exported model if `python app.py export` has produced it, else the weights."""
+    target = exported_model_path(path)
+    if target is None:
+        return path
+    if not os.path.exists(target):
+        logger.warning("Exported model %s not found, using %s; run `python app.py export` first",
+                       target, path)
+        return path
+    return target
+
+
+# Intra-op threads: CPUs this process may actually run on (respects container
+# cpusets/affinity, unlike os.cpu_count()); override with TORCH_THREADS.
+if hasattr(os, "sched_getaffinity"):
+    _available_cpus = len(os.sched_getaffinity(0))
+else:
+    _available_cpus = os.cpu_count() or 1
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", str(_available_cpus)))
+torch.set_num_threads(TORCH_THREADS)
+
+
+def load_model():
+    """Load the YOLO model and return it with the device it will run on."""
+    logger.info("Loading model from %s on device %s ...", MODEL_PATH, MODEL_DEVICE)
     try:
-        fallback = "yolov8n.pt"
-        print(f"[INFO] Attempting to load fallback model {fallback} on cpu...")
-        model = YOLO(fallback, device='cpu')
-        print("[INFO] Fallback model loaded ✅ (cpu)")
-    except Exception as e2:
-        tb2 = traceback.format_exc()
-        print("[CRITICAL] Fallback model load failed:")
-        print(tb2)
-        raise
+        model = YOLO(resolve_model_path(MODEL_PATH), task="detect")
+        logger.info("Model loaded ✅")
+        return model, MODEL_DEVICE
+    except Exception as e:
+        logger.exception("Failed to load model")
+        # Try fallback to a small official model to keep service alive
+        try:
+            fallback = "yolov8n.pt"
+            logger.warning("Attempting to load fallback model %s on cpu...", fallback)
+            model = YOLO(fallback)
+            logger.warning("Fallback model loaded ✅ (cpu)")
+            return model, "cpu"
+        except Exception as e2:
+            logger.critical("Fallback model load failed", exc_info=True)
+            raise
+
+
+# Set by get_model(); importing this module does not load anything
+model = None
+NAMES = ()   # class names as a tuple indexed by class id (model.names is a dict)
+_HEALTH = None   # /health body, fixed once the model has loaded
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Load and warm up the model on first use; later calls return the same instance.
+
+    gunicorn calls this from post_worker_init (see gunicorn.conf.py), so a
+    worker is warm before it serves its first request.
+    """
+    global model, MODEL_DEVICE, NAMES, _HEALTH, _INPUT_DTYPE, _PIN_INPUT
+
+    if model is None:
+        with _model_lock:
+            if model is None:
+                loaded, MODEL_DEVICE = load_model()
+                NAMES = tuple(loaded.names[i] for i in range(len(loaded.names)))
+                _HEALTH = {"status": "ok", "model_loaded": True, "classes": len(NAMES)}
+                warmup_model(loaded)
+                _PIN_INPUT = USE_CUDA and MODEL_DEVICE != "cpu"
+                backend = getattr(loaded.predictor, "model", None)   # set up by warmup
+                if _PIN_INPUT and getattr(backend, "fp16", False):
+                    _INPUT_DTYPE = torch.float16
+                model = loaded
+                threading.Thread(target=_batch_worker, name="batch-worker", daemon=True).start()
+    return model
+
+
+NO_DETECT = ("No disease", "0%")   # (label, confidence) when nothing is detected
+
+
+MIN_JPEG_SIZE = 256
+_JPEG_SOI = b"\xff\xd8"
+_JPEG_EOI = b"\xff\xd9"
+
+
+def looks_like_jpeg(img_bytes):
+    """Cheap sanity check (size, SOI and EOI markers) done before a full decode."""
+    return (len(img_bytes) >= MIN_JPEG_SIZE
+            and img_bytes.startswith(_JPEG_SOI)
+            # some camera drivers pad the frame after the EOI marker
+            and img_bytes.find(_JPEG_EOI, -16) != -1)
+
+
+def decode_jpeg(img_bytes):
+    """Decode JPEG bytes to a BGR ndarray, or return None if they are not a valid image."""
+    if _turbo is not None:
+        try:
+            return _turbo.decode(img_bytes, pixel_format=TJPF_BGR)
+        except Exception:
+            pass   # e.g. CMYK/Adobe JPEGs; OpenCV may still decode them
+    return cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+
+_INV_255 = 1 / 255.0
+_PAD_VALUE = 114   # same grey padding Ultralytics uses for letterboxing
+
+
+# Per-thread scratch buffers, reused across requests to avoid allocator churn.
+# Safe because a request thread waits for its result before preprocessing again.
+_scratch = threading.local()
+
+# Input tensor layout, set by get_model(). On CUDA the per-thread input tensor is
+# pinned (page-locked) so its host->device copy is an async DMA, and it is kept
+# in the model's own dtype (FP16 for a half-precision engine).
+_INPUT_DTYPE = torch.float32
+_PIN_INPUT = False
+
+
+def _scratch_buffers():
+    bufs = getattr(_scratch, "bufs", None)
+    if bufs is None:
+        canvas = np.full((MODEL_IMGSZ, MODEL_IMGSZ, 3), _PAD_VALUE, dtype=np.uint8)
+        tensor = torch.empty((3, MODEL_IMGSZ, MODEL_IMGSZ), dtype=_INPUT_DTYPE, pin_memory=_PIN_INPUT)
+        bufs = _scratch.bufs = (canvas, tensor)
+    return bufs
+
+
+def preprocess(img):
+    """Letterbox a BGR image to MODEL_IMGSZ and return a normalized RGB CHW float tensor.
+
+    Feeding the model a ready tensor skips Ultralytics' per-image Python
+    preprocessing. The returned tensor is a per-thread buffer that the next
+    call on the same thread overwrites.
+    """
+    canvas, tensor = _scratch_buffers()
+
+    h, w = img.shape[:2]
+    scale = min(MODEL_IMGSZ / h, MODEL_IMGSZ / w)
+    new_w, new_h = round(w * scale), round(h * scale)
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    if new_w == MODEL_IMGSZ and new_h == MODEL_IMGSZ:
+        canvas = img
+    else:
+        top = (MODEL_IMGSZ - new_h) // 2
+        left = (MODEL_IMGSZ - new_w) // 2
+        canvas[...] = _PAD_VALUE
+        canvas[top:top + new_h, left:left + new_w] = img
+
+    # BGR HWC -> RGB CHW, scaled to [0, 1] straight into the float buffer
+    np.multiply(canvas[..., ::-1].transpose(2, 0, 1), _INV_255, out=tensor.numpy(), dtype=np.float32)
+    return tensor
+
+
+# ------------- Batched inference -------------
+# Only the top box is used, so NMS keeps a single detection per image. imgsz matches
+# preprocess() so the predictor is set up and warmed up for the real input shape.
+PREDICT_KWARGS = {"imgsz": MODEL_IMGSZ, "conf": CONF_THRES, "iou": IOU_THRES, "max_det": 1,
+                  "verbose": False}
+# Requests from several ESP32s are queued and fused into a single model call.
+_infer_queue = queue.Queue()
+
+
+def _batch_worker():
+    while True:
+        items = [_infer_queue.get()]
+        deadline = time.monotonic() + BATCH_TIMEOUT
+        while len(items) < BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(_infer_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        try:
+            if _PIN_INPUT:
+                # Non-blocking copies straight from each request's pinned buffer,
+                # stacked on the device
+                batch = torch.stack([tensor.to(MODEL_DEVICE, non_blocking=True) for tensor, _ in items])
+            else:
+                batch = torch.stack([tensor for tensor, _ in items])
+            results = model(batch, device=MODEL_DEVICE, **PREDICT_KWARGS)
+            for (_, slot), result in zip(items, results):
+                slot["result"] = result
+        except Exception as e:
+            for _, slot in items:
+                slot["error"] = e
+        finally:
+            for _, slot in items:
+                slot["event"].set()
+
+
+def predict(img):
+    """Queue a decoded BGR image for batched inference and wait for its result."""
+    get_model()
+    slot = {"event": threading.Event()}
+    _infer_queue.put((preprocess(img), slot))
+    slot["event"].wait()
+    if "error" in slot:
+        raise slot["error"]
+    return slot["result"]
+
+
+def pick_best(boxes):
+    """Return (confidence, class id) of the top box; NMS already keeps only that one."""
+    conf, cls = boxes.data[0, -2:].tolist()   # single device->host copy
+    return conf, int(cls)
+
+
+def warmup_model(model):
+    """Run dummy forward passes so the first real requests don't pay the cold-start cost."""
+    for batch_size in sorted({1, BATCH_SIZE}):
+        try:
+            dummy = torch.zeros((batch_size, 3, MODEL_IMGSZ, MODEL_IMGSZ), dtype=torch.float32)
+            model(dummy, device=MODEL_DEVICE, **PREDICT_KWARGS)
+        except Exception:
+            logger.exception("Warmup with batch size %d failed", batch_size)
+    logger.info("Model warmed up")
+
+
+@app.errorhandler(413)
+def payload_too_large(e):
+    # Same JSON shape as the other upload errors instead of Werkzeug's HTML page
+    return jsonify({
+        "status": "error",
+        "message": f"Image too large (max {app.config['MAX_CONTENT_LENGTH']} bytes)"
+    }), 413
 
 
 @app.route("/upload", methods=["POST"])
@@ -47,46 +395,39 @@ def upload():
 
     if not img_bytes:
         return jsonify({"status": "error", "message": "No image data"}), 400
+    if not looks_like_jpeg(img_bytes):
+        return jsonify({"status": "error", "message": "Invalid image data"}), 400
 
-    # Create a filename with timestamp and save
-    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"image_{ts}.jpg"
+    # Create a unique filename and save
+    filename = f"image_{_RUN_ID}_{next(_seq):08x}.jpg"
     filepath = os.path.join(UPLOAD_FOLDER, filename)
-    
-    try:
-        with open(filepath, "wb") as f:
-            f.write(img_bytes)
-        print(f"[INFO] Saved: {filepath}, size = {len(img_bytes)} bytes")
-    except Exception as e:
-        print(f"[ERROR] Failed to save image: {e}")
-        return jsonify({"status": "error", "message": "Failed to save image"}), 500
+    save_image_async(filepath, img_bytes)
 
     # ------------- Run YOLO inference -------------
     try:
-        # Run model on the saved image
-        results = model(filepath)[0]   # first (and only) image
+        # Decode once in memory; the model never touches the saved file
+        img = decode_jpeg(img_bytes)
+        if img is None:
+            return jsonify({"status": "error", "message": "Invalid image data"}), 400
+
+        results = predict(img)
 
         if results.boxes is None or len(results.boxes) == 0:
             # No detection
-            result_label = "No disease"
-            confidence_str = "0%"
+            result_label, confidence_str = NO_DETECT
         else:
             boxes = results.boxes
 
-            # Pick the most confident detection
-            best_idx = boxes.conf.argmax().item()
-            cls_id = int(boxes.cls[best_idx].item())
-            conf = float(boxes.conf[best_idx].item())
+            # NMS already kept only the most confident detection
+            conf, cls_id = pick_best(boxes)
 
-            result_label = model.names[cls_id]       # class name from YOLO
+            result_label = NAMES[cls_id]       # class name from YOLO
             confidence_str = f"{conf * 100:.1f}%"
 
-        print(f"[INFO] Prediction: {result_label} ({confidence_str})")
+        logger.debug("Prediction: %s (%s)", result_label, confidence_str)
 
     except Exception as e:
-        tb = traceback.format_exc()
-        print("[ERROR] Inference failed:")
-        print(tb)
+        logger.exception("Inference failed")
         return jsonify({
             "status": "error",
             "message": "Model inference failed",
@@ -102,22 +443,35 @@ def upload():
     }), 200
 
 
-if __name__ == "__main__":
-    # Run on all interfaces so ESP32 can reach it over LAN
-    app.run(host="0.0.0.0", port=5000, debug=True)
-
-
 @app.route("/health", methods=["GET"])
 def health():
     try:
-        loaded = model is not None
-        names = getattr(model, "names", None)
-        return jsonify({
-            "status": "ok" if loaded else "error",
-            "model_loaded": bool(loaded),
-            "classes": len(names) if names is not None else None
-        }), 200
+        # Loads the model if nothing else has yet (launchers other than our
+        # gunicorn.conf.py), so a health-gated balancer doesn't wait forever
+        get_model()
+        return jsonify(_HEALTH), 200
     except Exception as e:
-        tb = traceback.format_exc()
-        print("[ERROR] Health check failed:\n", tb)
-        return jsonify({"status": "error", "message": str(e)}), 500
+        logger.exception("Health check failed")
+        return jsonify({
+            "status": "error",
+            "model_loaded": False,
+            "classes": None,
+            "message": str(e)
+        }), 503
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["export"]:
+        # Build step, see export_model() for where to run it
+        export_model()
+        sys.exit(0)
+
+    # Local development only; in production run under gunicorn (see Procfile):
+    #   gunicorn app:app -k gthread --workers 1 --threads 8 --bind 0.0.0.0:5000
+    # A single worker keeps one model in memory and lets every request thread
+    # feed the same batch queue.
+    get_model()
+    # Run on all interfaces so ESP32 can reach it over LAN.
+    # No reloader: it re-runs this file in a child process, which would load
+    # a second copy of the model.
+    app.run(host="0.0.0.0", port=5000, threaded=True, use_reloader=False)
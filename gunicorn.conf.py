@@ -0,0 +1,7 @@
+# Gunicorn reads this file from the working directory automatically.
+
+
+def post_worker_init(worker):
+    # Load and warm up the model before the worker accepts requests
+    import app
+    app.get_model()